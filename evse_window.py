@@ -1,64 +1,187 @@
 #!/usr/bin/env python3
 
 import argparse
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, time, timedelta
-import re
-from typing import Dict, List, Mapping, Tuple
+from functools import reduce
+from itertools import accumulate
+import json
+from operator import xor
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
-RatesType = List[Tuple[datetime, float]]
+# hour ending timestamps and the price for each of those hours
+RatesType = Tuple[List[datetime], 'array[float]']
 StartEndType = Tuple[datetime, datetime]
 
+# window costs closer together than this are considered equal
+COST_EPSILON = 1e-6
+
+# where fetched prices are kept between runs
+CACHE_DIR = Path.home() / ".cache" / "comed-evse"
+
+# last schedule successfully set on the charger, and how long to trust it
+# before asking the charger again in case it was changed elsewhere
+SCHEDULE_CACHE = CACHE_DIR / "last_schedule.json"
+SCHEDULE_CACHE_MAX_AGE = timedelta(days=7)
+
+def cache_path(when: date) -> Path:
+    """Returns the path of the on-disk cache entry for the given date's prices."""
+    return CACHE_DIR / f"{when.strftime('%Y%m%d')}.json"
+
+def read_cache(path: Path) -> Optional[Dict[str, Any]]:
+    """Returns the cache entry stored at path, or None if it is missing or unreadable."""
+    try:
+        with path.open() as cache_file:
+            entry: Dict[str, Any] = json.load(cache_file)
+            return entry
+    except (OSError, ValueError):
+        return None
+
+def write_cache(path: Path, entry: Mapping[str, Any]) -> None:
+    """Stores a cache entry at path; failures are ignored as the cache is optional."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as cache_file:
+            json.dump(entry, cache_file)
+    except OSError:
+        pass
+
+def cached_rates(entry: Mapping[str, Any]) -> RatesType:
+    """Returns the rates stored in a cache entry."""
+    times = [datetime.fromisoformat(ts) for ts, _ in entry['rates']]
+    prices = array('d', (rate for _, rate in entry['rates']))
+    return times, prices
+
+def cache_modified(path: Path) -> Optional[datetime]:
+    """Returns when the cache entry at path was written, or None if it is missing."""
+    try:
+        return datetime.fromtimestamp(path.stat().st_mtime)
+    except OSError:
+        return None
+
+def cache_is_final(path: Path, when: date) -> bool:
+    """Returns True if the cache entry at path was written after the given
+    date was over, at which point its prices can no longer change."""
+    modified = cache_modified(path)
+    return modified is not None and modified >= datetime.combine(when + timedelta(days=1), time())
+
 def fetch_for_date(session: requests.Session, when: date) -> RatesType:
     """Fetch the ComEd day-ahead hourly prices for the given date."""
     # curl 'https://hourlypricing.comed.com/rrtp/ServletFeed?type=daynexttoday&date=20200726'
     url = "https://hourlypricing.comed.com/rrtp/ServletFeed"
     params = {"type": "daynexttoday", "date": when.strftime("%Y%m%d")}
-    response = session.get(url, params=params)
+    path = cache_path(when)
+    cached = read_cache(path)
+    if cached is not None and cached.get('rates') and cache_is_final(path, when):
+        return cached_rates(cached)
+
+    # revalidate previously fetched prices rather than downloading them again
+    headers = {}
+    if cached is not None and cached.get('rates'):
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    response = session.get(url, params=params, headers=headers)
     response.raise_for_status()
+    if response.status_code == 304 and cached is not None and cached.get('rates'):
+        # rewrite the entry so its timestamp reflects this confirmation
+        write_cache(path, cached)
+        return cached_rates(cached)
     txt = response.text
     if len(txt) == 0:
         raise Exception("empty prices response")
 
     # format: "[[Date.UTC(2020,6,18,0,0,0), 1.8], ...]"
     # note that they aren't UTC at all, they are America/Chicago TZ
-    date_re = re.compile(
-        r"\[Date\.UTC\((?P<y>\d+),(?P<m>\d+),(?P<d>\d+),(?P<h>\d+),0,0\), (?P<rate>\d+\.\d+)\]")
 
-    # parse the JS-style date/rate feed
-    rates = []
-    for val in date_re.finditer(txt):
-        # JS dates use 0-indexed months, thus the `+ 1`
-        parsed_time = datetime(int(val.group('y')), int(val.group('m')) + 1,
-                               int(val.group('d')), int(val.group('h')))
-        rates.append((parsed_time, float(val.group('rate'))))
+    # parse the JS-style date/rate feed; every row starts with the same
+    # literal prefix, so split on that rather than running a regex. Any
+    # number is accepted as a rate, as prices can be negative or whole.
+    times = []
+    prices = array('d')
+    for row in txt.split("[Date.UTC(")[1:]:
+        try:
+            date_part, _, rate_part = row.partition(")")
+            # only the first four fields vary; minutes and seconds are always 0
+            year, month, day, hour, _ = date_part.split(",", 4)
+            # JS dates use 0-indexed months, thus the `+ 1`
+            parsed_time = datetime(int(year), int(month) + 1, int(day), int(hour))
+            # rate_part looks like ", 1.8], "
+            rate = float(rate_part[1:rate_part.index("]")])
+        except ValueError as ex:
+            raise Exception(f"unexpected prices feed format: {row[:40]!r}") from ex
+        times.append(parsed_time)
+        prices.append(rate)
 
-    return rates
+    if times:
+        write_cache(path, {
+            "etag": response.headers.get('ETag'),
+            "last_modified": response.headers.get('Last-Modified'),
+            "rates": [[ts.isoformat(), rate] for ts, rate in zip(times, prices)],
+        })
+
+    return times, prices
 
 def fetch_rates(session: requests.Session, second_day: date) -> RatesType:
     """Fetch two days worth of rates and retain the values from 5 PM until 5 PM the second day."""
-    rates_a = fetch_for_date(session, second_day - timedelta(days=1))
-    rates_b = fetch_for_date(session, second_day)
+    # both requests are independent, so overlap their network round trips
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_a = executor.submit(fetch_for_date, session, second_day - timedelta(days=1))
+        future_b = executor.submit(fetch_for_date, session, second_day)
+        times_a, prices_a = future_a.result()
+        times_b, prices_b = future_b.result()
 
     # TODO: hardcoded assumption we run this in the 5 PM hour
-    cutoff = time.fromisoformat("18:00")
-    rates_a = [r for r in rates_a if r[0].time() >= cutoff]
-    rates_b = [r for r in rates_b if r[0].time() < cutoff]
+    # rates are always on the hour, so comparing hours is enough
+    cutoff_hour = 18
+    rates_a = [r for r in zip(times_a, prices_a) if r[0].hour >= cutoff_hour]
+    rates_b = [r for r in zip(times_b, prices_b) if r[0].hour < cutoff_hour]
     rates = rates_a + rates_b
+    times = [r[0] for r in rates]
+    prices = array('d', (r[1] for r in rates))
+
+    return times, prices
 
-    return rates
+def find_cheapest_start(prices: Sequence[float], charge_minutes: int) -> int:
+    """Returns the minute, counted from the start of the given hourly prices,
+    at which the lowest cost window of `charge_minutes` begins."""
+    totals = [0.0, *accumulate(prices)]
 
-def convert_rates(rates: RatesType) -> RatesType:
-    """Converts 'hour ending' rates as returned by the hourly pricing API into
-    a per-minute timeset with the expected rate for each particular minute."""
-    new_rates: RatesType = []
-    for end_hour, price in rates:
-        start_hour = end_hour - timedelta(hours=1)
-        new_rates.extend([(start_hour + timedelta(minutes=offset), price) for offset in range(60)])
+    def cost_until(minute: int) -> float:
+        """Cost of charging from the start of the data set until `minute`."""
+        hour, offset = divmod(minute, 60)
+        cost = totals[hour] * 60
+        if offset:
+            cost += prices[hour] * offset
+        return cost
 
-    return new_rates
+    # sliding windows approach to minimizing cost; find the lowest cost
+    # window of the proper length in the data set. As a window slides within
+    # an hour its cost changes linearly, so the cheapest window always starts
+    # or ends on an hour boundary and only those windows need to be checked.
+    last_start = len(prices) * 60 - charge_minutes
+    if last_start < 0:
+        raise ValueError(f"{len(prices)} hours of prices is not enough "
+                         f"for a {charge_minutes} minute charge window")
+    candidates = sorted({*range(0, last_start + 1, 60),
+                         *range(-charge_minutes % 60, last_start + 1, 60)})
+    best_cost, best_start = float('inf'), 0
+    for minute in candidates:
+        cost = cost_until(minute + charge_minutes) - cost_until(minute)
+        # differences of totals carry floating point error, so require a
+        # window to be meaningfully cheaper; ties keep the earliest window
+        if cost < best_cost - COST_EPSILON:
+            best_cost, best_start = cost, minute
+
+    return best_start
 
 def find_optimal_window(rates: RatesType, charge_hours: float, awake_until: time) -> StartEndType:
     """Calculate a start and end time to allow charging to occur. The first
@@ -67,19 +190,21 @@ def find_optimal_window(rates: RatesType, charge_hours: float, awake_until: time
     was scheduled to end earlier. This allows things like car preheat/precool
     to be able to draw power from the EVSE."""
     charge_minutes = round(charge_hours * 60)
-    rates = convert_rates(rates)
-    # sliding windows approach to minimizing cost; find the lowest cost
-    # window of the proper length in the data set.
-    windows = [0.0] * (len(rates) - charge_minutes + 1)
-    for i in range(len(windows)):
-        # multiply rates by 10 to avoid floating point rounding errors
-        windows[i] = sum(r[1] * 10 for r in rates[i:i+charge_minutes])
+    times, prices = rates
 
-    start_idx = min(range(len(windows)), key=windows.__getitem__)
-    end_idx = start_idx + charge_minutes
+    def minute_time(minute: int) -> datetime:
+        """Time of the given minute, taken from the timestamp of the hour it
+        falls in so missing or repeated hours (DST changes) are respected."""
+        hour, offset = divmod(minute, 60)
+        if hour == len(times):
+            # the very end of the data set is the end of the last hour
+            return times[-1]
+        # rates are 'hour ending', so each hour starts an hour before its timestamp
+        return times[hour] - timedelta(hours=1) + timedelta(minutes=offset)
 
-    start = rates[start_idx][0]
-    end = rates[end_idx][0]
+    start_minute = find_cheapest_start(prices, charge_minutes)
+    start = minute_time(start_minute)
+    end = minute_time(start_minute + charge_minutes)
 
     # one minute padding to ensure we don't start or end in wrong hour
     # if EVSE and electric meter clocks do not exactly match up
@@ -98,14 +223,15 @@ class RAPI:
     def __init__(self, session: requests.Session, url: str):
         self.session = session
         self.url = url
+        # proxy and TLS settings from the environment are the same for every
+        # command, so merge them once rather than on each request
+        self.send_settings = session.merge_environment_settings(url, {}, None, None, None)
 
     @staticmethod
     def checksum(cmd: str) -> str:
         """Returns calculated checksum for given RAPI command."""
-        cksum = 0
-        for char in cmd:
-            cksum ^= ord(char)
-        return hex(cksum)[2:].upper()
+        cksum = reduce(xor, cmd.encode('ascii'), 0)
+        return f"{cksum:X}"
 
     def cmd_with_checksum(self, cmd: str) -> str:
         """Returns RAPI command with calculated appended checksum."""
@@ -115,9 +241,13 @@ class RAPI:
     def execute_cmd(self, cmd: str) -> Mapping[str, str]:
         """Executes an RAPI command and returns the parsed JSON response."""
         params = {"json": 1, "rapi": self.cmd_with_checksum(cmd)}
-        response = self.session.get(self.url, params=params)
+        # prepared per command so cookies set by earlier responses are sent
+        request = self.session.prepare_request(requests.Request("GET", self.url, params=params))
+        response = self.session.send(request, **self.send_settings)
         response.raise_for_status()
-        parsed: Dict[str, str] = response.json()
+        # parse the raw body; json detects its encoding itself, which avoids
+        # requests guessing a charset to build response.text
+        parsed: Dict[str, str] = json.loads(response.content)
         ret = parsed['ret'].split('^')
         expected_cksum = self.checksum(ret[0])
         if ret[1] != expected_cksum:
@@ -128,6 +258,15 @@ class RAPI:
 
     def set_schedule(self, start: datetime, end: datetime) -> None:
         """Set the delay timer schedule to the given start and end time."""
+        schedule = [start.hour, start.minute, end.hour, end.minute]
+        cached = read_cache(SCHEDULE_CACHE)
+        modified = cache_modified(SCHEDULE_CACHE)
+        if (cached is not None and cached.get('url') == self.url
+                and cached.get('schedule') == schedule and modified is not None
+                and datetime.now() - modified < SCHEDULE_CACHE_MAX_AGE):
+            print("Skipping schedule update, no change (local cache):", schedule)
+            return
+
         response = self.execute_cmd("$GD")
         expected = f"$OK {start.hour} {start.minute} {end.hour} {end.minute}"
         if response['ret_value'] == expected:
@@ -136,6 +275,9 @@ class RAPI:
             cmd = f"$ST {start.hour} {start.minute} {end.hour} {end.minute}"
             response = self.execute_cmd(cmd)
             print("RAPI response:", response)
+            if not response['ret_value'].startswith("$OK"):
+                return
+        write_cache(SCHEDULE_CACHE, {"url": self.url, "schedule": schedule})
 
 def main() -> None:
     """Parse arguments, execute the scheduler, and update the charger."""
@@ -153,6 +295,12 @@ def main() -> None:
     args = parser.parse_args()
 
     session = requests.Session()
+    # keep connections to ComEd and the charger open across requests, and
+    # retry briefly on connection failures
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                          max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     rates = fetch_rates(session, args.date)
     start, end = find_optimal_window(rates, args.hours, args.awake_until)
     print(f"Time window: {start} {end}")